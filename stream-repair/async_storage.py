@@ -0,0 +1,329 @@
+"""
+asyncio I/O layer for the GCS JSON API, used by make_release_notification.py.
+
+All requests go through one pooled aiohttp session. Metadata calls are issued
+concurrently up to a limit, and large objects are downloaded as concurrent
+byte-range chunks written into place in the destination file.
+
+If STORAGE_EMULATOR_HOST is set (the same variable google-cloud-storage honors),
+requests go to that host unauthenticated instead of storage.googleapis.com, so
+this can be run offline against a local fake object store, e.g.
+STORAGE_EMULATOR_HOST=http://localhost:4443
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import random
+import threading
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import quote
+
+import aiohttp
+
+DEFAULT_ENDPOINT = "https://storage.googleapis.com"
+READ_ONLY_SCOPE = "https://www.googleapis.com/auth/devstorage.read_only"
+
+# Max simultaneous connections in the session pool
+MAX_CONNECTIONS = 32
+# Max metadata requests in flight at once
+MAX_METADATA_REQUESTS = 16
+# Objects larger than this are downloaded as concurrent range requests
+CHUNKED_DOWNLOAD_THRESHOLD = 32 * 1024 * 1024
+CHUNK_SIZE = 16 * 1024 * 1024
+# Max range requests in flight at once for a single object
+MAX_CHUNKS_PER_OBJECT = 8
+# Requests failing with a transient error are retried with exponential backoff,
+# like the google-cloud-storage client's default retry for reads
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 6
+RETRY_INITIAL_DELAY = 1.0
+RETRY_MAX_DELAY = 32.0
+
+
+@dataclass(frozen=True)
+class ObjectInfo:
+    """
+    Object metadata from a listing or get. Attribute names mirror
+    google.cloud.storage.blob.Blob so either can be passed to blob helpers.
+    """
+    bucket: str
+    name: str
+    size: int
+    md5_hash: Optional[str] = None
+    crc32c: Optional[str] = None
+    generation: Optional[int] = None
+
+    @staticmethod
+    def from_resource(resource: dict) -> "ObjectInfo":
+        generation = resource.get("generation")
+        return ObjectInfo(
+            bucket=resource["bucket"],
+            name=resource["name"],
+            size=int(resource["size"]),
+            md5_hash=resource.get("md5Hash"),
+            crc32c=resource.get("crc32c"),
+            generation=int(generation) if generation is not None else None)
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status in RETRY_STATUSES
+    return isinstance(e, (aiohttp.ClientConnectionError,
+                          aiohttp.ClientPayloadError,
+                          asyncio.TimeoutError))
+
+
+async def with_retries(fn):
+    """
+    Returns await fn(), calling it again after a transient error, up to
+    MAX_ATTEMPTS in total. fn must issue the whole request each time it is called.
+    """
+    delay = RETRY_INITIAL_DELAY
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return await fn()
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS or not is_retryable(e):
+                raise
+        await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+        delay = min(delay * 2, RETRY_MAX_DELAY)
+
+
+# Application default credentials, shared by every AsyncStorage so that sync
+# callers going through run() do not repeat discovery and token fetches
+default_credentials = None
+default_credentials_lock = threading.Lock()
+
+
+def get_default_credentials():
+    global default_credentials
+    with default_credentials_lock:
+        if default_credentials is None:
+            import google.auth
+            default_credentials, _ = google.auth.default(scopes=[READ_ONLY_SCOPE])
+        return default_credentials
+
+
+def bucket_name_of(bucket) -> str:
+    """
+    Returns the name of bucket, which may be a str or a storage.Bucket.
+    """
+    if isinstance(bucket, str):
+        return bucket
+    return bucket.name
+
+
+class AsyncStorage:
+    """
+    Async client for reading objects from GCS buckets.
+    Use as an async context manager so the session is closed:
+
+    async with AsyncStorage() as store:
+        objects = await store.list_objects("mybucket", "p1/")
+    """
+
+    def __init__(self, endpoint: str = None, credentials=None):
+        emulator_host = os.environ.get("STORAGE_EMULATOR_HOST")
+        if endpoint is None:
+            endpoint = emulator_host or DEFAULT_ENDPOINT
+        if not endpoint.startswith("http"):
+            endpoint = "http://" + endpoint
+        self.endpoint = endpoint.rstrip("/")
+        self.credentials = credentials
+        # Only authenticate against the real service
+        self.anonymous = credentials is None and self.endpoint != DEFAULT_ENDPOINT
+        self.session = None
+        self.metadata_semaphore = asyncio.Semaphore(MAX_METADATA_REQUESTS)
+        self.refresh_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        if not self.anonymous and self.credentials is None:
+            self.credentials = get_default_credentials()
+        if not self.anonymous:
+            # Only fetches a token if the cached one is missing or expired
+            await self._refresh_credentials()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS),
+            raise_for_status=True)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def _refresh_credentials(self):
+        """
+        Refreshes the credentials if they are not valid. The refresh is a
+        blocking HTTP call, so it is run in the default executor.
+        """
+        async with self.refresh_lock:
+            if self.credentials.valid:
+                return
+            import google.auth.transport.requests
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.credentials.refresh,
+                google.auth.transport.requests.Request())
+
+    async def _headers(self, extra: dict = None) -> dict:
+        headers = dict(extra or {})
+        if not self.anonymous:
+            if not self.credentials.valid:
+                await self._refresh_credentials()
+            headers["Authorization"] = "Bearer " + self.credentials.token
+        return headers
+
+    def _object_url(self, bucket: str, name: str) -> str:
+        return "{}/storage/v1/b/{}/o/{}".format(
+            self.endpoint, quote(bucket, safe=""), quote(name, safe=""))
+
+    async def _get_json(self, url: str, params: dict = None) -> dict:
+        async def get():
+            async with self.session.get(url, params=params,
+                                        headers=await self._headers()) as resp:
+                return await resp.json()
+        async with self.metadata_semaphore:
+            return await with_retries(get)
+
+    async def list_objects(self, bucket: str, prefix: str = None) -> list:
+        """
+        Returns an ObjectInfo for every object in bucket under prefix,
+        following pagination.
+        """
+        url = "{}/storage/v1/b/{}/o".format(self.endpoint,
+                                            quote(bucket, safe=""))
+        params = {}
+        if prefix:
+            params["prefix"] = prefix
+        out = []
+        while True:
+            page = await self._get_json(url, params)
+            out.extend(ObjectInfo.from_resource(r)
+                       for r in page.get("items", []))
+            if "nextPageToken" not in page:
+                return out
+            params["pageToken"] = page["nextPageToken"]
+
+    async def get_object(self, bucket: str, name: str) -> ObjectInfo:
+        resource = await self._get_json(self._object_url(bucket, name))
+        return ObjectInfo.from_resource(resource)
+
+    async def get_objects(self, bucket: str, names: list) -> list:
+        """
+        Returns ObjectInfos for names in the same order, with the metadata
+        requests pipelined over the session.
+        """
+        return list(await asyncio.gather(
+            *[self.get_object(bucket, name) for name in names]))
+
+    async def read_object(self, bucket: str, name: str,
+                          byte_range: tuple = None) -> bytes:
+        """
+        Returns the object content. byte_range is an inclusive (start, end).
+        """
+        headers = {}
+        if byte_range is not None:
+            headers["Range"] = "bytes={}-{}".format(*byte_range)
+
+        async def get():
+            async with self.session.get(self._object_url(bucket, name),
+                                        params={"alt": "media"},
+                                        headers=await self._headers(headers)) as resp:
+                return await resp.read()
+        return await with_retries(get)
+
+    async def download_to_filename(self, obj: ObjectInfo, path: str):
+        """
+        Writes the content of obj to path. Objects over
+        CHUNKED_DOWNLOAD_THRESHOLD are fetched as concurrent range requests.
+        Content is written to path + ".tmp" and only moved to path once the
+        whole object has been fetched, so a failed download leaves nothing at path.
+        """
+        tmp_path = path + ".tmp"
+        try:
+            if obj.size <= CHUNKED_DOWNLOAD_THRESHOLD:
+                await self._download_whole(obj, tmp_path)
+            else:
+                await self._download_chunked(obj, tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+
+    async def _download_whole(self, obj: ObjectInfo, path: str):
+        async def get():
+            # Each attempt rewrites the file from the start
+            written = 0
+            async with self.session.get(self._object_url(obj.bucket, obj.name),
+                                        params={"alt": "media"},
+                                        headers=await self._headers()) as resp:
+                with open(path, "wb") as fout:
+                    async for data in resp.content.iter_chunked(1024 * 1024):
+                        fout.write(data)
+                        written += len(data)
+            return written
+        written = await with_retries(get)
+        if written != obj.size:
+            raise RuntimeError(
+                "Short read of {}: expected {} bytes, got {}".format(
+                    obj.name, obj.size, written))
+
+    async def _download_chunked(self, obj: ObjectInfo, path: str):
+        # Preallocate so each chunk can be written at its own offset
+        with open(path, "wb") as fout:
+            fout.truncate(obj.size)
+        semaphore = asyncio.Semaphore(MAX_CHUNKS_PER_OBJECT)
+
+        async def fetch_chunk(start):
+            # read_object retries by re-issuing the same range
+            end = min(start + CHUNK_SIZE, obj.size) - 1
+            async with semaphore:
+                data = await self.read_object(obj.bucket, obj.name,
+                                              (start, end))
+            if len(data) != end - start + 1:
+                raise RuntimeError(
+                    "Short read of {} bytes {}-{}: got {} bytes".format(
+                        obj.name, start, end, len(data)))
+            with open(path, "r+b") as fout:
+                fout.seek(start)
+                fout.write(data)
+
+        tasks = [asyncio.ensure_future(fetch_chunk(start))
+                 for start in range(0, obj.size, CHUNK_SIZE)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the remaining chunks before the partial file is removed
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def download_all(self, pairs: list):
+        """
+        Takes a list of (ObjectInfo, path) and downloads them concurrently.
+        """
+        await asyncio.gather(*[self.download_to_filename(obj, path)
+                               for obj, path in pairs])
+
+
+def run(fn):
+    """
+    Calls fn with an open AsyncStorage and runs the resulting coroutine
+    to completion. This is the entry point for synchronous callers:
+
+    objects = run(lambda store: store.list_objects("mybucket", "p1/"))
+
+    If the calling thread already has a running event loop (e.g. in Jupyter),
+    the coroutine is run on its own loop in a worker thread.
+    """
+    async def go():
+        async with AsyncStorage() as store:
+            return await fn(store)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(go())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, go()).result()
@@ -0,0 +1,244 @@
+"""
+Offline checks for async_storage against a local fake GCS JSON API server.
+
+Run from this directory:
+python check_async_storage.py
+"""
+
+import asyncio
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+
+import google_crc32c
+from aiohttp import web
+
+import async_storage
+from async_storage import AsyncStorage
+
+BUCKET = "test-bucket"
+
+
+class FakeGCS:
+    """
+    Serves objects held in memory over the subset of the GCS JSON API used by
+    async_storage: object listing with pagination, object metadata, and media
+    downloads with Range support.
+    Failures can be injected with fail_ranges (respond 503 to the first N
+    requests for each distinct range), fail_lists (respond 503 to the next N listing requests) and
+    short_ranges (drop the last byte of range responses).
+    """
+
+    def __init__(self, page_size=2):
+        self.objects = {}
+        self.page_size = page_size
+        self.fail_ranges = 0
+        self.range_failures = {}
+        self.fail_lists = 0
+        self.short_ranges = False
+        self.requests = []
+
+    def put(self, name: str, data: bytes):
+        self.objects[name] = data
+
+    def resource(self, name: str) -> dict:
+        data = self.objects[name]
+        return {
+            "bucket": BUCKET,
+            "name": name,
+            "size": str(len(data)),
+            "md5Hash": base64.b64encode(hashlib.md5(data).digest()).decode(),
+            "crc32c": base64.b64encode(google_crc32c.value(data).to_bytes(4, "big")).decode(),
+            "generation": "1"
+        }
+
+    async def get_bucket(self, request):
+        # Any bucket exists, for storage.Client.get_bucket at import of make_release_notification
+        return web.json_response({"kind": "storage#bucket",
+                                  "name": request.match_info["bucket"]})
+
+    async def list_objects(self, request):
+        self.requests.append(("list", request.query.get("pageToken")))
+        if self.fail_lists > 0:
+            self.fail_lists -= 1
+            return web.Response(status=503)
+        prefix = request.query.get("prefix", "")
+        names = sorted(n for n in self.objects if n.startswith(prefix))
+        start = int(request.query.get("pageToken", "0"))
+        page = {"items": [self.resource(n)
+                          for n in names[start:start + self.page_size]]}
+        if start + self.page_size < len(names):
+            page["nextPageToken"] = str(start + self.page_size)
+        return web.json_response(page)
+
+    async def get_object(self, request):
+        name = request.match_info["name"]
+        if name not in self.objects:
+            return web.json_response({}, status=404)
+        if request.query.get("alt") != "media":
+            self.requests.append(("get", name))
+            return web.json_response(self.resource(name))
+        data = self.objects[name]
+        byte_range = request.headers.get("Range")
+        if byte_range is None:
+            self.requests.append(("media", name))
+            return web.Response(body=data)
+        self.requests.append(("range", name))
+        failures = self.range_failures.get((name, byte_range), 0)
+        if failures < self.fail_ranges:
+            self.range_failures[(name, byte_range)] = failures + 1
+            return web.Response(status=503)
+        start, end = byte_range.split("=")[1].split("-")
+        data = data[int(start):int(end) + 1]
+        if self.short_ranges:
+            data = data[:-1]
+        return web.Response(body=data, status=206)
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get("/storage/v1/b/{bucket}", self.get_bucket)
+        app.router.add_get("/storage/v1/b/{bucket}/o", self.list_objects)
+        app.router.add_get("/storage/v1/b/{bucket}/o/{name:.+}", self.get_object)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.endpoint = "http://127.0.0.1:{}".format(
+            site._server.sockets[0].getsockname()[1])
+
+    def start(self):
+        """
+        Serves on an event loop in a daemon thread, so the server keeps
+        responding while a client blocks the caller's loop.
+        """
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+async def check_listing(fake, store):
+    objects = await store.list_objects(BUCKET, "rel1/")
+    assert [o.name for o in objects] == sorted(n for n in fake.objects
+                                               if n.startswith("rel1/")), objects
+    # 5 objects at 2 per page
+    assert [r for r in fake.requests if r[0] == "list"] == \
+        [("list", None), ("list", "2"), ("list", "4")], fake.requests
+    assert objects[0].size == len(fake.objects[objects[0].name])
+    assert objects[0].crc32c == fake.resource(objects[0].name)["crc32c"]
+
+
+async def check_get_objects(fake, store):
+    names = ["rel1/gene/created/000000000000", "rel1/release_date.txt"]
+    objects = await store.get_objects(BUCKET, names)
+    assert [o.name for o in objects] == names, objects
+    assert await store.read_object(BUCKET, "rel1/release_date.txt") == b"2022-01-01\n"
+
+
+async def check_downloads(fake, store, tmpdir):
+    small = await store.get_object(BUCKET, "rel1/gene/created/000000000000")
+    large = await store.get_object(BUCKET, "rel1/variation/created/000000000000")
+    small_path = os.path.join(tmpdir, "small")
+    large_path = os.path.join(tmpdir, "large")
+    fake.requests.clear()
+    await store.download_all([(small, small_path), (large, large_path)])
+    with open(small_path, "rb") as f:
+        assert f.read() == fake.objects[small.name]
+    with open(large_path, "rb") as f:
+        assert f.read() == fake.objects[large.name]
+    range_requests = [r for r in fake.requests if r[0] == "range"]
+    assert len(range_requests) == -(-large.size // async_storage.CHUNK_SIZE), fake.requests
+    assert ("media", small.name) in fake.requests
+
+
+async def check_failed_download(fake, store, tmpdir, what):
+    large = await store.get_object(BUCKET, "rel1/variation/created/000000000000")
+    path = os.path.join(tmpdir, "failed-" + what)
+    fake.range_failures.clear()
+    try:
+        await store.download_to_filename(large, path)
+    except Exception:
+        pass
+    else:
+        raise AssertionError(what + " did not raise")
+    # Nothing may be left behind for a size-only cache check to accept
+    assert not os.path.exists(path), path
+    assert not os.path.exists(path + ".tmp"), path
+
+
+async def check_retried_download(fake, store, tmpdir):
+    large = await store.get_object(BUCKET, "rel1/variation/created/000000000000")
+    path = os.path.join(tmpdir, "retried")
+    fake.requests.clear()
+    fake.range_failures.clear()
+    await store.download_to_filename(large, path)
+    with open(path, "rb") as f:
+        assert f.read() == fake.objects[large.name]
+    # Each range is re-issued until it succeeds
+    range_requests = [r for r in fake.requests if r[0] == "range"]
+    chunks = -(-large.size // async_storage.CHUNK_SIZE)
+    assert len(range_requests) == chunks * (fake.fail_ranges + 1), fake.requests
+
+
+async def check_retried_listing(fake, store):
+    fake.requests.clear()
+    objects = await store.list_objects(BUCKET, "rel1/")
+    assert len(objects) == 5, objects
+    assert [r for r in fake.requests if r[0] == "list"] == \
+        [("list", None), ("list", None), ("list", "2"), ("list", "4")], fake.requests
+
+
+async def check_run_in_event_loop(fake):
+    # The sync entry point is called from inside a running loop, as in Jupyter
+    os.environ["STORAGE_EMULATOR_HOST"] = fake.endpoint
+    content = async_storage.run(
+        lambda store: store.read_object(BUCKET, "rel2/release_date.txt"))
+    assert content == b"2022-01-08\n", content
+
+
+async def main():
+    # Small thresholds so the chunked path is exercised with small objects
+    async_storage.CHUNKED_DOWNLOAD_THRESHOLD = 100 * 1024
+    async_storage.CHUNK_SIZE = 30 * 1024
+    async_storage.RETRY_INITIAL_DELAY = 0.01
+    fake = FakeGCS()
+    fake.put("rel1/release_date.txt", b"2022-01-01\n")
+    fake.put("rel1/gene/created/000000000000", b'{"a": 1}\n{"a": 2}\n')
+    fake.put("rel1/submitter/created/000000000000", b'{"s": 1}\n')
+    fake.put("rel1/trait/created/000000000000", b'{"t": 1}\n')
+    fake.put("rel1/variation/created/000000000000",
+             b"".join(b'{"v": %d}\n' % i for i in range(20000)))
+    fake.put("rel2/release_date.txt", b"2022-01-08\n")
+    fake.start()
+    try:
+        async with AsyncStorage(fake.endpoint) as store:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                await check_listing(fake, store)
+                await check_get_objects(fake, store)
+                await check_downloads(fake, store, tmpdir)
+                fake.fail_ranges = 1
+                await check_retried_download(fake, store, tmpdir)
+                # Failures up to the retry limit are still recovered from
+                fake.fail_ranges = async_storage.MAX_ATTEMPTS - 1
+                await check_retried_download(fake, store, tmpdir)
+                fake.fail_lists = 1
+                await check_retried_listing(fake, store)
+                fake.fail_ranges = async_storage.MAX_ATTEMPTS
+                await check_failed_download(fake, store, tmpdir, "failed range request")
+                fake.fail_ranges = 0
+                fake.short_ranges = True
+                await check_failed_download(fake, store, tmpdir, "short range read")
+                fake.short_ranges = False
+        await check_run_in_event_loop(fake)
+    finally:
+        fake.stop()
+    print("async_storage checks passed")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,142 @@
+"""
+Offline checks for the local content store in make_release_notification.py:
+deduplication of identical shards across releases, memoized record counts,
+and recovery from corrupt stored copies.
+
+Run from this directory:
+python check_content_store.py
+"""
+
+import os
+import sys
+import tempfile
+
+from check_async_storage import BUCKET, FakeGCS
+
+GENE = b'{"g": 1}\n{"g": 2}\n'
+SUBMITTER_1 = b'{"s": 1}\n'
+SUBMITTER_2 = b'{"s": 1}\n{"s": 2}\n{"s": 3}\n'
+
+
+def media_requests(fake):
+    return [r for r in fake.requests if r[0] in ("media", "range")]
+
+
+def count_computes(m):
+    """
+    Wraps m.memoized_by_content and returns the list of content keys it computes.
+    """
+    computed = []
+    memoized_by_content = m.memoized_by_content
+
+    def wrapped(kind, blob, compute):
+        def counted():
+            computed.append(blob.name)
+            return compute()
+        return memoized_by_content(kind, blob, counted)
+    m.memoized_by_content = wrapped
+    return computed
+
+
+def check_shared_shard(fake, m):
+    r1 = ["r1/gene/created/000000000000", "r1/submitter/created/000000000000"]
+    r2 = ["r2/gene/created/000000000000", "r2/submitter/created/000000000000"]
+    fake.requests.clear()
+    counts = m.release_notification_file_record_counts(None, BUCKET, r1)
+    counts.update(m.release_notification_file_record_counts(None, BUCKET, r2))
+    assert counts == {r1[0]: 2, r1[1]: 1, r2[0]: 2, r2[1]: 3}, counts
+    # The gene shard is the same in both releases and downloaded once
+    assert sorted(media_requests(fake)) == [
+        ("media", r1[0]), ("media", r1[1]), ("media", r2[1])], fake.requests
+    assert os.path.samefile(r1[0], r2[0])
+    assert not os.path.samefile(r1[1], r2[1])
+    assert os.path.exists(m.content_memo_file("record_count"))
+
+
+def check_memoized_counts(fake, m):
+    files = ["r1/gene/created/000000000000", "r2/gene/created/000000000000",
+             "r2/submitter/created/000000000000"]
+    computed = count_computes(m)
+    fake.requests.clear()
+    counts = m.release_notification_file_record_counts(None, BUCKET, files)
+    assert counts == {files[0]: 2, files[1]: 2, files[2]: 3}, counts
+    assert computed == [], computed
+    assert media_requests(fake) == [], fake.requests
+    # Memos are read back from disk in a new process
+    m.content_memos.clear()
+    counts = m.release_notification_file_record_counts(
+        None, BUCKET, files, cache_locally=False)
+    assert counts == {files[0]: 2, files[1]: 2, files[2]: 3}, counts
+    assert computed == [], computed
+    assert media_requests(fake) == [], fake.requests
+
+
+def check_corrupt_store(fake, m):
+    blob = m.async_storage.run(
+        lambda store: store.get_object(BUCKET, "r3/gene/created/000000000000"))
+    stored_path = m.content_store_path(m.blob_content_key(blob))
+    # Same size, different content, as a failed write could leave it
+    os.remove(stored_path)
+    with open(stored_path, "wb") as fout:
+        fout.write(b"x" * len(GENE))
+    # A new process has not verified anything yet
+    m.verified_content_keys.clear()
+    fake.requests.clear()
+    path = m.blob_download_if_not(blob)
+    assert media_requests(fake) == [("media", blob.name)], fake.requests
+    with open(path, "rb") as f:
+        assert f.read() == GENE
+    with open(stored_path, "rb") as f:
+        assert f.read() == GENE
+    assert os.path.samefile(path, stored_path)
+
+
+def check_without_hardlinks(fake, m):
+    blob = m.async_storage.run(
+        lambda store: store.get_object(BUCKET, "r4/gene/created/000000000000"))
+    link = os.link
+
+    def no_link(src, dst):
+        raise OSError("hardlinks not supported")
+    os.link = no_link
+    try:
+        path = m.blob_download_if_not(blob)
+        assert not os.path.samefile(path, m.content_store_path(m.blob_content_key(blob)))
+        # The verified copy is accepted without another copy or request
+        mtime = os.stat(path).st_mtime_ns
+        fake.requests.clear()
+        assert m.blob_download_if_not(blob) == path
+        assert os.stat(path).st_mtime_ns == mtime
+        assert fake.requests == [], fake.requests
+    finally:
+        os.link = link
+
+
+def main():
+    fake = FakeGCS()
+    for release in ["r1", "r2", "r3", "r4"]:
+        fake.put(release + "/gene/created/000000000000", GENE)
+    fake.put("r1/submitter/created/000000000000", SUBMITTER_1)
+    fake.put("r2/submitter/created/000000000000", SUBMITTER_2)
+    fake.start()
+    cwd = os.getcwd()
+    try:
+        os.environ["STORAGE_EMULATOR_HOST"] = fake.endpoint
+        sys.path.insert(0, cwd)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Blob paths and the content store are relative to the working directory
+            os.chdir(tmpdir)
+            import make_release_notification as m
+            check_shared_shard(fake, m)
+            check_memoized_counts(fake, m)
+            check_corrupt_store(fake, m)
+            check_without_hardlinks(fake, m)
+            os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+        fake.stop()
+    print("content store checks passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,23 @@
+import asyncio
 import json
 import re
 import os
 import pathlib
+import shutil
+import base64
 from typing import Union
 import google.cloud
+import google_crc32c
 from google.cloud import storage
 
+import async_storage
+from async_storage import ObjectInfo, bucket_name_of
+
 storage_client = storage.Client(project="broad-dsp-monster-clingen-prod")
 bucket_name = "broad-dsp-monster-clingen-prod-ingest-results"
+# Local directory holding one copy of each distinct blob content, keyed by checksum.
+# Release paths in the working directory are hardlinks into it.
+content_store_dir = ".content-store"
 
 """
 Notification structure example:
@@ -34,7 +44,7 @@ def ensure_trailing_slash(s: str) -> str:
 
 
 def is_a_release_file(filename: str) -> bool:
-    if isinstance(filename, google.cloud.storage.blob.Blob):
+    if isinstance(filename, (google.cloud.storage.blob.Blob, ObjectInfo)):
         filename = blob_path(filename)
     # Is a diff file
     terms = filename.split("/")
@@ -52,11 +62,23 @@ def is_a_release_file(filename: str) -> bool:
     return False
 
 
-def generate_notif_for_release(client, bucket, release_prefix, release_date=None):
+def manifest_entry(blob) -> dict:
+    """
+    Returns the listing metadata recorded for a file in a notification manifest.
+    """
+    return {
+        "size": blob.size,
+        "md5_hash": blob.md5_hash,
+        "crc32c": blob.crc32c,
+        "generation": blob.generation
+    }
+
+
+async def generate_notif_for_release_async(store, bucket, release_prefix, release_date=None,
+                                           include_manifest=False):
     # List all files in bucket with release prefix
-    blob_iterator = client.list_blobs(bucket,
-                                      prefix=ensure_trailing_slash(release_prefix))
-    all_blobs = flatten1([[pb for pb in page] for page in blob_iterator.pages])
+    all_blobs = await store.list_objects(bucket_name_of(bucket),
+                                         ensure_trailing_slash(release_prefix))
     all_blobs = list(filter(is_a_release_file, all_blobs))
     # Get the release date stored in this release directory
     release_date_files = list(filter(lambda blob: blob.name.endswith("release_date.txt"),
@@ -67,8 +89,9 @@ def generate_notif_for_release(client, bucket, release_prefix, release_date=None
                 f"release_date not provided and {release_prefix} "
                 "did not contain release-date.txt")
         release_date_file = release_date_files[0]
-        with release_date_file.open() as f:
-            release_date = f.read().strip()
+        content = await store.read_object(release_date_file.bucket,
+                                          release_date_file.name)
+        release_date = content.decode("utf-8").strip()
 
     # Generate structure
     notification_msg = {
@@ -76,9 +99,25 @@ def generate_notif_for_release(client, bucket, release_prefix, release_date=None
         "bucket": bucket_name,
         "files": [b.name for b in all_blobs]
     }
+    if include_manifest:
+        notification_msg["manifest"] = {b.name: manifest_entry(b) for b in all_blobs}
     return notification_msg
 
 
+def generate_notif_for_release(client, bucket, release_prefix, release_date=None,
+                               include_manifest=False):
+    """
+    Synchronous wrapper over generate_notif_for_release_async.
+    client is unused, bucket access goes through async_storage.
+
+    If include_manifest is true, the notification also has a "manifest" of
+    filename -> {size, md5_hash, crc32c, generation} taken from the listing.
+    """
+    return async_storage.run(
+        lambda store: generate_notif_for_release_async(
+            store, bucket, release_prefix, release_date, include_manifest))
+
+
 def list_subtract(A: list, B: list) -> list:
     """
     Returns a copy of A with the elements in B removed.
@@ -138,14 +177,65 @@ def validate_notifs_equal(expecteds, actuals):
                  "\nactual: {}")
                 .format(exp_files_diff, act_files_diff,
                         json.dumps(exp), json.dumps(act)))
+        # Check content, if both sides carry a manifest
+        if "manifest" in exp and "manifest" in act:
+            validate_manifests_equal(exp["manifest"], act["manifest"])
 
 
-def regenerate_notifs(client, notifs: list) -> list:
+# Manifest fields which identify file content. generation changes whenever an
+# object is rewritten, even with identical bytes, so it is not compared.
+MANIFEST_CONTENT_FIELDS = ["size", "crc32c", "md5_hash"]
+MANIFEST_CHECKSUM_FIELDS = ["crc32c", "md5_hash"]
+
+
+def validate_manifests_equal(expected: dict, actual: dict):
+    """
+    Throws error if the manifests do not list the same files, or if any file's
+    size or checksums differ. Only listing metadata is compared, nothing is downloaded.
+    Also throws error if a file has no checksum present in both manifests,
+    since its content could not be compared.
+    """
+    (exp_files_diff, act_files_diff) = list_diff(sorted(expected), sorted(actual))
+    if ([], []) != (exp_files_diff, act_files_diff):
+        raise RuntimeError(
+            ("Manifest file listings are not equal"
+             "\nexp_files_diff: {}"
+             "\nact_files_diff: {}")
+            .format(exp_files_diff, act_files_diff))
+    mismatches = {}
+    unchecked = {}
+    for file_name, exp_entry in expected.items():
+        act_entry = actual[file_name]
+        # md5_hash is absent for composite objects
+        compared = [field for field in MANIFEST_CONTENT_FIELDS
+                    if exp_entry.get(field) is not None
+                    and act_entry.get(field) is not None]
+        if not any(field in MANIFEST_CHECKSUM_FIELDS for field in compared):
+            unchecked[file_name] = {"expected": exp_entry,
+                                    "actual": act_entry}
+        if any(exp_entry[field] != act_entry[field] for field in compared):
+            mismatches[file_name] = {"expected": exp_entry,
+                                     "actual": act_entry}
+    if mismatches:
+        raise RuntimeError(
+            "Manifest file contents are not equal:\n" +
+            json.dumps(mismatches, indent=2))
+    if unchecked:
+        raise RuntimeError(
+            "Manifest files have no checksum to compare:\n" +
+            json.dumps(unchecked, indent=2))
+
+
+def regenerate_notifs(client, notifs: list, include_manifest=False,
+                      keep_release_dates=False) -> list:
     """
     Takes a list of notification messages, and regenerates them based on the bucket and dir info in it.
     Returns a list of the regenerated notifications in the same order iterated over the input collection.
+
+    If keep_release_dates is true, each input notification's release_date is used instead of
+    reading release_date.txt from the bucket, so only listings are fetched.
     """
-    out = []
+    requests = []
     for in_notif in notifs:
         topic_bucket = in_notif["bucket"]
         topic_files = in_notif["files"]
@@ -155,13 +245,36 @@ def regenerate_notifs(client, notifs: list) -> list:
             if not tf.startswith(release_prefix):
                 raise RuntimeError("Files did not all start with same prefix:\n" +
                                    str(in_notif))
-        # Generate a release notification that should match the one on the topic
-        generated_notif = generate_notif_for_release(
-            client,
-            topic_bucket,
-            release_prefix)
-        out.append(generated_notif)
-    return out
+        release_date = in_notif["release_date"] if keep_release_dates else None
+        requests.append((topic_bucket, release_prefix, release_date))
+
+    # Generate release notifications that should match the ones on the topic.
+    # Listings for all releases are issued concurrently over one session.
+    async def generate_all(store):
+        return await asyncio.gather(
+            *[generate_notif_for_release_async(store, topic_bucket, release_prefix,
+                                               release_date, include_manifest)
+              for (topic_bucket, release_prefix, release_date) in requests])
+    return list(async_storage.run(generate_all))
+
+
+def validate_release_integrity(client, notifs: list):
+    """
+    Takes a list of notification messages with manifests, such as previously
+    generated with include_manifest=True, and checks that the bucket still
+    holds exactly those files with the same sizes and checksums.
+    Only listings are fetched, so this is cheap to run over the full history.
+    release_date.txt is not read, its content is checked by its manifest checksum.
+    """
+    # Without a manifest only file names would be compared
+    missing_manifest = [n["release_date"] for n in notifs if "manifest" not in n]
+    if missing_manifest:
+        raise RuntimeError(
+            "Notifications have no manifest to validate against, release dates: " +
+            str(missing_manifest))
+    regenerated = regenerate_notifs(client, notifs, include_manifest=True,
+                                    keep_release_dates=True)
+    validate_notifs_equal(notifs, regenerated)
 
 
 def release_to_dir_mapping(notifs: list) -> list:
@@ -185,9 +298,13 @@ def release_dir_map_to_notifications(
     Takes a list of (release_date, dirname) and generates and
     returns the notification messages in the same order
     """
+    async def generate_all(store):
+        return await asyncio.gather(
+            *[generate_notif_for_release_async(store, bucket, release_prefix)
+              for (_, release_prefix) in release_dir_mappings])
+    notifs = async_storage.run(generate_all)
     out = []
-    for (release_date, release_prefix) in release_dir_mappings:
-        notif = generate_notif_for_release(client, bucket, release_prefix)
+    for (release_date, release_prefix), notif in zip(release_dir_mappings, notifs):
         if release_date != notif["release_date"]:
             raise RuntimeError(
                 ("Release date retrieved from bucket prefix did not match" +
@@ -203,14 +320,9 @@ def release_notification_file_sizes(client, bucket, files: list) -> dict:
     For each file in the list, obtain the file size in the bucket.
     Returns a dict of filename(str) -> size in bytes(int).
     """
-    # https://cloud.google.com/python/docs/reference/storage/latest/google.cloud.storage.blob.Blob
-    # if bucket was str, should resolve here
-    bucket = client.get_bucket(bucket)
-    out = {}
-    for file_name in files:
-        blob = bucket.get_blob(file_name)
-        out[file_name] = blob.size
-    return out
+    objects = async_storage.run(
+        lambda store: store.get_objects(bucket_name_of(bucket), files))
+    return {obj.name: obj.size for obj in objects}
 
 
 def makeparents(path: str):
@@ -224,17 +336,264 @@ def makeparents(path: str):
     pathlib.Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
 
 
-def blob_download_if_not(blob):
+def as_object_info(blob) -> ObjectInfo:
+    """
+    Returns blob as an ObjectInfo. blob may be an ObjectInfo or a storage.Blob.
+    """
+    if isinstance(blob, ObjectInfo):
+        return blob
+    return ObjectInfo(bucket=bucket_name_of(blob.bucket),
+                      name=blob.name,
+                      size=blob.size,
+                      md5_hash=blob.md5_hash,
+                      crc32c=blob.crc32c,
+                      generation=blob.generation)
+
+
+def file_crc32c(path: str, chunk_size=4 * 1024 * 1024) -> str:
+    """
+    Returns the CRC32C of a local file, base64 encoded the way GCS reports it.
+    Streams the file so large shards are not read into memory.
+    """
+    checksum = google_crc32c.Checksum()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode("utf-8")
+
+
+def local_file_matches(path: str, size: int, crc32c: str = None) -> bool:
+    """
+    Returns true if path is a file of the given size and, if crc32c is
+    provided, with that checksum.
+    """
+    if not (os.path.exists(path) and os.path.isfile(path)):
+        return False
+    if os.path.getsize(path) != size:
+        return False
+    return crc32c is None or file_crc32c(path) == crc32c
+
+
+def blob_is_cached(blob, verify_checksum=False) -> bool:
     path = blob_path(blob)
     assert len(path) > 0, {"blob": blob}
-    if os.path.exists(path) and os.path.isfile(path):
-        if os.path.getsize(path) == blob.size:
-            return path
-        os.remove(path)
-    print(f"Downloading {path}")
-    makeparents(path)
-    blob.download_to_filename(path)
-    return path
+    return local_file_matches(path, blob.size,
+                              blob.crc32c if verify_checksum else None)
+
+
+content_memos = {}
+# Memo kinds with results not yet written by save_content_memos
+unsaved_memo_kinds = set()
+
+
+def content_memo_file(kind: str) -> str:
+    return os.path.join(content_store_dir, "memo", kind + ".json")
+
+
+def load_content_memo(kind: str) -> dict:
+    if kind not in content_memos:
+        memo_file = content_memo_file(kind)
+        if os.path.exists(memo_file):
+            with open(memo_file) as f:
+                content_memos[kind] = json.load(f)
+        else:
+            content_memos[kind] = {}
+    return content_memos[kind]
+
+
+def memoized_by_content(kind: str, blob, compute):
+    """
+    Returns compute() for blob, memoized under kind by the blob's content key,
+    so results for identical shards in different releases are computed once.
+    New results are persisted in content_store_dir by save_content_memos.
+    """
+    key = blob_content_key(blob)
+    if key is None:
+        return compute()
+    memo = load_content_memo(kind)
+    if key not in memo:
+        memo[key] = compute()
+        unsaved_memo_kinds.add(kind)
+    return memo[key]
+
+
+def save_content_memos():
+    """
+    Writes the memos with new results to content_store_dir.
+    """
+    for kind in sorted(unsaved_memo_kinds):
+        memo_file = content_memo_file(kind)
+        makeparents(memo_file)
+        with open(memo_file + ".tmp", "w") as fout:
+            json.dump(content_memos[kind], fout)
+        os.replace(memo_file + ".tmp", memo_file)
+    unsaved_memo_kinds.clear()
+
+
+def is_memoized_by_content(kind: str, blob) -> bool:
+    key = blob_content_key(blob)
+    return key is not None and key in load_content_memo(kind)
+
+
+def unique_by_content(blobs: list) -> list:
+    """
+    Returns blobs with only the first of each content key kept.
+    Blobs without a content key are all kept.
+    """
+    seen = set()
+    out = []
+    for blob in blobs:
+        key = blob_content_key(blob)
+        if key is None or key not in seen:
+            out.append(blob)
+        if key is not None:
+            seen.add(key)
+    return out
+
+
+def verify_local_manifest(manifest: dict) -> dict:
+    """
+    Checks the locally cached copy of each file in a notification manifest
+    against its size and crc32c.
+    Returns a dict of filename -> "missing" | "mismatch" for the files that failed.
+    """
+    out = {}
+    for file_name, entry in manifest.items():
+        if not os.path.isfile(file_name):
+            out[file_name] = "missing"
+        elif not local_file_matches(file_name, entry["size"], entry["crc32c"]):
+            out[file_name] = "mismatch"
+    return out
+
+
+def blob_content_key(blob) -> Union[str, None]:
+    """
+    Returns a key identifying the content of blob, from its listing metadata.
+    Returns None if the blob has no crc32c, in which case it is not deduplicated.
+    """
+    if blob.crc32c is None:
+        return None
+    key = "{}-{}".format(blob.size, base64.b64decode(blob.crc32c).hex())
+    if blob.md5_hash is not None:
+        key += "-" + base64.b64decode(blob.md5_hash).hex()
+    return key
+
+
+def content_store_path(key: str) -> str:
+    return os.path.join(content_store_dir, "objects", key)
+
+
+# Content keys whose stored copy has had its crc32c checked by this process
+verified_content_keys = set()
+
+
+def content_store_has(blob) -> bool:
+    """
+    Returns true if the content store holds a copy of blob that matches its
+    crc32c. A stored copy that does not match is removed.
+    Each key is checked once per process.
+    """
+    key = blob_content_key(blob)
+    stored_path = content_store_path(key)
+    if key in verified_content_keys:
+        return os.path.exists(stored_path)
+    if not os.path.exists(stored_path):
+        return False
+    if not local_file_matches(stored_path, blob.size, blob.crc32c):
+        print(f"Removing corrupt stored copy {stored_path}")
+        os.remove(stored_path)
+        return False
+    verified_content_keys.add(key)
+    return True
+
+
+def link_or_copy(src: str, dst: str):
+    """
+    Hardlinks dst to src, falling back to a copy if the filesystem does not allow it.
+    """
+    makeparents(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def blob_is_linked_to_store(blob) -> bool:
+    """
+    Returns true if the local path of blob is a link to its verified stored content,
+    or, where link_or_copy had to copy, a copy that matches it.
+    """
+    path = blob_path(blob)
+    if not (content_store_has(blob) and os.path.isfile(path)):
+        return False
+    return (os.path.samefile(path, content_store_path(blob_content_key(blob)))
+            or local_file_matches(path, blob.size, blob.crc32c))
+
+
+async def blobs_download_if_not_async(store, blobs: list, verify_checksum=False) -> list:
+    """
+    Downloads each blob that is not already cached locally, concurrently.
+    If verify_checksum is true, cached copies must also match the blob's crc32c.
+    Returns the local paths in the same order as blobs.
+
+    Content is deduplicated through content_store_dir: a blob whose content key is
+    already stored is linked into place instead of downloaded, and blobs sharing a
+    key are downloaded once. Since other releases link to stored content, blobs with
+    a content key are always checked against their crc32c, whatever verify_checksum is.
+    """
+    to_download = {}
+    to_link = []
+    for blob in blobs:
+        path = blob_path(blob)
+        key = blob_content_key(blob)
+        if key is None:
+            if blob_is_cached(blob, verify_checksum):
+                continue
+            if os.path.exists(path):
+                os.remove(path)
+            print(f"Downloading {path}")
+            makeparents(path)
+            to_download[path] = as_object_info(blob)
+            continue
+        stored_path = content_store_path(key)
+        if blob_is_linked_to_store(blob):
+            continue
+        if not content_store_has(blob) and blob_is_cached(blob, verify_checksum=True):
+            # Make a copy cached before deduplication available to other releases
+            link_or_copy(path, stored_path)
+            verified_content_keys.add(key)
+            continue
+        if os.path.exists(path):
+            os.remove(path)
+        if stored_path not in to_download and not content_store_has(blob):
+            print(f"Downloading {path}")
+            makeparents(stored_path)
+            to_download[stored_path] = as_object_info(blob)
+        to_link.append((stored_path, path))
+    await store.download_all([(obj, path) for path, obj in to_download.items()])
+    # Verify downloads before anything is linked to them
+    for stored_path, obj in to_download.items():
+        if obj.crc32c is None:
+            continue
+        if not local_file_matches(stored_path, obj.size, obj.crc32c):
+            os.remove(stored_path)
+            raise RuntimeError(
+                "Downloaded content of {} did not match crc32c {}".format(
+                    obj.name, obj.crc32c))
+        verified_content_keys.add(blob_content_key(obj))
+    for stored_path, path in to_link:
+        link_or_copy(stored_path, path)
+    return [blob_path(blob) for blob in blobs]
+
+
+def blob_download_if_not(blob, verify_checksum=False):
+    if blob_content_key(blob) is None:
+        if blob_is_cached(blob, verify_checksum):
+            return blob_path(blob)
+    elif blob_is_linked_to_store(blob):
+        return blob_path(blob)
+    return async_storage.run(
+        lambda store: blobs_download_if_not_async(store, [blob], verify_checksum))[0]
 
 
 def blob_download_open(blob):
@@ -258,30 +617,46 @@ def release_notification_file_record_counts(client, bucket, files: list, cache_l
     For each file in the list, obtain the number of nonempty lines.
     Returns a dict of filename(str) -> count(int).
 
-    If cache_locally is true, will download all of the blobs in the files list to the working
+    If cache_locally is true, will download the blobs in the files list to the working
     directory and read from there. Next use of blob_download_open should be faster.
+
+    Counts are memoized by content checksum, so shards identical to one already
+    counted are not re-counted. They are linked into the working directory if their
+    content is in the local content store, and otherwise not downloaded at all.
     """
-    # https://cloud.google.com/python/docs/reference/storage/latest/google.cloud.storage.blob.Blob
-    # if bucket was str, should resolve here
-    bucket = client.get_bucket(bucket)
-    out = {}
+    bucket = bucket_name_of(bucket)
 
-    def do_open(blob):
+    async def fetch_all(store):
+        blobs = await store.get_objects(bucket, files)
         if cache_locally:
-            return blob_download_open(blob)
-        else:
-            return blob.open()
-
-    for file_name in files:
-        blob = bucket.get_blob(file_name)
-        line_count = 0
-        # with blob.open() as f:
-        with do_open(blob) as f:
-            for line in f:
-                if len(line.strip()) > 0:
-                    line_count += 1
-        out[file_name] = line_count
-        # print("Line count for file {} was {}".format(file_name, line_count))
+            # blobs_download_if_not_async downloads shared content once and links the rest
+            await blobs_download_if_not_async(
+                store, [b for b in blobs
+                        if not is_memoized_by_content("record_count", b)
+                        or content_store_has(b)])
+            return blobs, None
+        pending = unique_by_content(
+            [b for b in blobs if not is_memoized_by_content("record_count", b)])
+        contents = await asyncio.gather(
+            *[store.read_object(bucket, b.name) for b in pending])
+        return blobs, {b.name: content for b, content in zip(pending, contents)}
+    (blobs, contents) = async_storage.run(fetch_all)
+
+    def count_lines(lines):
+        return sum(1 for line in lines if len(line.strip()) > 0)
+
+    def count_blob(blob):
+        if cache_locally:
+            with open(blob_path(blob)) as f:
+                return count_lines(f)
+        return count_lines(contents[blob.name].splitlines())
+
+    out = {}
+    for blob in blobs:
+        out[blob.name] = memoized_by_content("record_count", blob,
+                                             lambda: count_blob(blob))
+        # print("Line count for file {} was {}".format(blob.name, out[blob.name]))
+    save_content_memos()
     return out
 
 